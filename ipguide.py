@@ -1,14 +1,41 @@
 #!/bin/env python3
-from ipaddress import IPv4Network, ip_network
+from array import array
+from collections import defaultdict
+from functools import cached_property, lru_cache
+from ipaddress import IPv4Address, IPv4Network, IPv6Address, ip_network
 import csv
+import gc
+import gzip
 import logging
 from pathlib import Path
 import time
-import pickle
+import marshal
+import mmap
 import time
-import subprocess
+from socket import AF_INET, AF_INET6, inet_pton
+import shutil
+import struct
+import sys
+import urllib.request
 from typing import Any
 
+# bump this whenever the layout of the cached database changes
+CACHE_VERSION = 9
+CACHE_MAGIC = b"IPGUIDE\0"
+# the trie's arrays are cached as native machine data, so a cache can only
+# be used on a machine with the same byte order and int size
+CACHE_BYTEORDER = sys.byteorder[0].encode()
+CACHE_INTSIZE = array('i').itemsize
+# magic, version, byte order, int size and number of sections, followed by 
+# an offset and length per section
+CACHE_HEADER = struct.Struct("<8sIcBI")
+CACHE_SECTION = struct.Struct("<QQ")
+
+# networks which aren't in ip.guide, recorded as belonging to ASN 0
+PRIVATE_NETWORKS = ('10.0.0.0/8', '127.0.0.0/8',
+                    '172.16.0.0/12', '192.168.0.0/16',
+                    '::1/128', 'fc00::/7', 'fe80::/10')
+
 def main():
     start = time.time()
     x = IPGuide("network.csv")
@@ -22,74 +49,460 @@ def main():
     print(x.find_asn(87))
 
 
+class _Node:
+    """A NetTree node while the tree is being built.  bits is the integer value
+    of the first depth bits of the node's prefix, c0 and c1 are the children."""
+    __slots__ = ('c0', 'c1', 'data', 'depth', 'bits')
+
+    def __init__(self, depth: int, bits: int, data: Any=None):
+        self.c0 = None
+        self.c1 = None
+        self.data = data
+        self.depth = depth
+        self.bits = bits
+
+
 class NetTree:    
-    """Search Tree for CIDR nodes"""
+    """Search Tree for CIDR nodes.
 
-    def __init__(self):
-        "Initialize the tree as empty"
-        self.tree = [None, None, None]
+    IPv4 and IPv6 networks are kept in separate tries, 32 and 128 bits deep,
+    so IPv4 lookups work on small ints and never walk through an IPv6 
+    prefix.  IPv4-mapped IPv6 addresses (::ffff:0:0/96) are treated as IPv4.
+
+    While it is being built each trie is a path-compressed (PATRICIA) binary
+    trie of _Nodes:  chains of single-child nodes are collapsed into one edge.
+
+    Once it's built, compile() turns both into multibit tries for searching,
+    sharing one set of arrays with the IPv4 root at node 0 and the IPv6 
+    root at node 1.  Each compiled node starts at the depth of a branching PATRICIA node and 
+    has STRIDE_SLOTS slots, one for each value of the next STRIDE bits, so a
+    lookup consumes STRIDE bits per step.  Each slot holds the index of the 
+    most specific data within the node's window, and the index of the child
+    node for longer prefixes.  Prefixes shorter than the window are expanded
+    into every slot they cover.  The data itself is kept in arrays holding 
+    the prefix and the enclosing data (parent) of each entry.
+
+    Like an LC-trie, the walk doesn't check the bits skipped by compressed
+    edges.  Instead, the data it finds is checked against the address at the
+    end, falling back through its parents until one actually contains it.
 
+    Networks inserted after compile() go into a small overlay NetTree which
+    searches also check, keeping the more specific match.  Call compile() 
+    again to fold the overlay into the arrays.
+    """
 
-    def dump(self, node=None, path="", depth=0) -> str:
-        """Return a textual representation of the tree """
-        if node is None:
-            node = self.tree
+    STRIDE = 4
+    STRIDE_SLOTS = 1 << STRIDE
+
+    def __init__(self):
+        "Initialize the tree as empty"
+        # the IPv4 and IPv6 roots, and the path taken by the last insert into each
+        self.tree = (_Node(0, 0), _Node(0, 0))
+        self._paths = ([self.tree[0]], [self.tree[1]])
+        # compiled nodes: depth per node, children and data per slot
+        self._depth = None
+        self._children = None
+        self._entries = None
+        # data: prefix depth and bits, enclosing data index, and the object.
+        # The first _v4_data entries are IPv4.
+        self._v4_data = None
+        self._data_depth = None
+        self._data_bits = None
+        self._data_parent = None
+        self._data_objs = None
+        # networks inserted since the tree was compiled
+        self._overlay = None
+
+
+    def dump(self) -> str:
+        """Return a textual representation of the tree.  Networks inserted
+        since the last compile() are listed after the compiled ones."""
+        if self.tree is not None:
+            items = [(width, node.depth, node.bits, node.data) for width, node in self._nodes()]
+        else:
+            # the data is numbered in tree order
+            items = [(32 if i < self._v4_data else 128, depth, bits, data)
+                     for i, (depth, bits, data) in enumerate(zip(self._data_depth, self._data_bits, self._data_objs))]
+            if self._overlay is not None:
+                items.extend((width, node.depth, node.bits, node.data) for width, node in self._overlay._nodes())
         res = ""
-        if node[2]:
-            res += f"{path}: {node[2]}\n"
-        for i in (0, 1):
-            if node[i] is None:
-                continue
-            res += self.dump(node[i], path + str(i), depth + 1)
+        for width, depth, bits, data in items:
+            family = "IPv4" if width == 32 else "IPv6"
+            res += f"{family} {bits:0{depth}b}: {data}\n" if depth else f"{family} : {data}\n"
         return res
 
 
-    def insert(self, network: str, data: Any):
-        """Insert the data at the appropriate part of the tree"""
+    def _nodes(self):
+        """Yield the address width and _Node of each network in the uncompiled
+        tree, in tree order"""
+        for width, root in zip((32, 128), self.tree):
+            stack = [root]
+            while stack:
+                node = stack.pop()
+                if node.data:
+                    yield width, node
+                stack.extend(child for child in (node.c1, node.c0) if child is not None)
+
+
+    def compile(self):
+        """Turn the tree into the arrays used for searching.  If the tree is
+        already compiled, this rebuilds it to include the overlay."""
+        if self.tree is None:
+            if self._overlay is None:
+                return
+            overlay = self._overlay
+            self._thaw()
+            for width, node in overlay._nodes():
+                self._insert(width, node.bits << (width - node.depth), node.depth, node.data)
+        data_depth = array('B')
+        data_bits = []
+        data_parent = array('i')
+        data_objs = []
+        # number the data depth-first, which also finds each one's parent
+        index = {}
+        v4_data = 0
+        stack = [(self.tree[1], -1), (self.tree[0], -1)]
+        while stack:
+            node, parent = stack.pop()
+            if node is self.tree[1]:
+                v4_data = len(data_objs)
+            if node.data:
+                index[node] = len(data_objs)
+                data_depth.append(node.depth)
+                data_bits.append(node.bits)
+                data_parent.append(parent)
+                data_objs.append(node.data)
+                parent = index[node]
+            for child in (node.c1, node.c0):
+                if child is not None:
+                    stack.append((child, parent))
+
+        stride = self.STRIDE
+        slots = self.STRIDE_SLOTS
+        depth = array('B')
+        children = array('i')
+        entries = array('i')
+
+        def new_node(node):
+            depth.append(node.depth)
+            children.extend([-1] * slots)
+            # a node's own prefix covers every slot unless something longer does
+            entries.extend([index.get(node, -1)] * slots)
+            return len(depth) - 1
+
+        work = [(root, new_node(root)) for root in self.tree]
+        while work:
+            top, n = work.pop()
+            d = top.depth
+            base = n * slots
+            # parents are visited before their children, so longer prefixes
+            # overwrite the slots of the shorter ones containing them.
+            stack = [child for child in (top.c1, top.c0) if child is not None]
+            while stack:
+                node = stack.pop()
+                k = node.depth - d
+                if k < stride:
+                    if node.data:
+                        first = (node.bits & ((1 << k) - 1)) << (stride - k)
+                        for slot in range(first, first + (1 << (stride - k))):
+                            entries[base + slot] = index[node]
+                    stack.extend(child for child in (node.c1, node.c0) if child is not None)
+                    continue
+                slot = (node.bits >> (k - stride)) & (slots - 1)
+                if node.data:
+                    # if this is deeper than the window it's only a candidate,
+                    # which search() checks against the address.
+                    entries[base + slot] = index[node]
+                if node.c0 is not None or node.c1 is not None:
+                    child = new_node(node)
+                    children[base + slot] = child
+                    work.append((node, child))
+
+        self._depth = depth
+        self._children = children
+        self._entries = entries
+        self._v4_data = v4_data
+        self._data_depth = data_depth
+        self._data_bits = data_bits
+        self._data_parent = data_parent
+        self._data_objs = data_objs
+        self.tree = None
+        self._paths = None
+        self._overlay = None
+
+
+    def _thaw(self):
+        """Rebuild the _Node tree from the data so it can be modified"""
+        if self.tree is not None:
+            return
+        data = zip(self._data_depth, self._data_bits, self._data_objs)
+        self.tree = (_Node(0, 0), _Node(0, 0))
+        self._paths = ([self.tree[0]], [self.tree[1]])
+        for i, (depth, bits, obj) in enumerate(data):
+            width = 32 if i < self._v4_data else 128
+            self._insert(width, bits << (width - depth), depth, obj)
+        self._depth = self._children = self._entries = self._v4_data = None
+        self._data_depth = self._data_bits = self._data_parent = self._data_objs = None
+
+
+    # the arrays and their typecodes.  These are what the cache stores raw
+    # so they can be used straight out of a memory mapped file.
+    ARRAYS = (('depth', 'B'), ('children', 'i'), ('entries', 'i'),
+              ('data_depth', 'B'), ('data_parent', 'i'))
+
+    def to_dict(self) -> dict:
+        """Return the compiled tree's arrays and lists for caching, compiling
+        the tree and its overlay first"""
+        self.compile()
+        return {'depth': self._depth,
+                'children': self._children,
+                'entries': self._entries,
+                'v4_data': self._v4_data,
+                'data_depth': self._data_depth,
+                'data_bits': self._data_bits,
+                'data_parent': self._data_parent,
+                'data_objs': self._data_objs}
+
+
+    @classmethod
+    def from_dict(cls, state: dict) -> "NetTree":
+        """Create a compiled tree from the output of to_dict().  The arrays can
+        be any indexable sequence of ints, such as a memoryview of a cache file."""
+        tree = cls()
+        tree.tree = None
+        tree._paths = None
+        tree._depth = state['depth']
+        tree._children = state['children']
+        tree._entries = state['entries']
+        tree._v4_data = state['v4_data']
+        tree._data_depth = state['data_depth']
+        tree._data_bits = state['data_bits']
+        tree._data_parent = state['data_parent']
+        tree._data_objs = state['data_objs']
+        return tree
+
+
+    @staticmethod
+    def _parse(network) -> tuple[int, int, int]:
+        """Convert a network into its address width (32 or 128), integer 
+        address and prefix length.  The network can be a string, an 
+        IPv4Address/IPv6Address, a packed 4 or 16 byte address, an int 
+        (treated as IPv4 if it fits in 32 bits, like ip_address does), or 
+        anything else ip_network accepts."""
+        if isinstance(network, str):
+            # inet_pton parses the address in C, which is far cheaper than building
+            # an ip_network.  Anything it doesn't handle cleanly (netmasks, host 
+            # bits set, garbage) goes through ip_network for the usual handling.
+            address, slash, prefixlen = network.partition('/')
+            try:
+                if ':' in address:
+                    width = 128
+                    addr = int.from_bytes(inet_pton(AF_INET6, address), 'big')
+                else:
+                    width = 32
+                    addr = int.from_bytes(inet_pton(AF_INET, address), 'big')
+                plen = width
+                if slash:
+                    if not (prefixlen.isascii() and prefixlen.isdigit()):
+                        raise ValueError(prefixlen)
+                    plen = int(prefixlen)
+                    if plen > width or addr & ((1 << (width - plen)) - 1):
+                        raise ValueError(network)
+                if width == 32 or addr >> 32 != 0xffff or plen < 96:
+                    return width, addr, plen
+                return 32, addr & 0xffff_ffff, plen - 96
+            except (OSError, ValueError):
+                pass
+        elif isinstance(network, IPv4Address):
+            return 32, int(network), 32
+        elif isinstance(network, bytes) and len(network) == 4:
+            # a packed address, as from inet_pton
+            return 32, int.from_bytes(network, 'big'), 32
+        elif isinstance(network, bytes) and len(network) == 16:
+            network = int.from_bytes(network, 'big')
+            if network >> 32 == 0xffff:
+                return 32, network & 0xffff_ffff, 32
+            return 128, network, 128
+        elif isinstance(network, IPv6Address):
+            network = int(network)
+            if network >> 32 == 0xffff:
+                return 32, network & 0xffff_ffff, 32
+            return 128, network, 128
+        elif isinstance(network, int) and 0 <= network < (1 << 128):
+            if network < (1 << 32):
+                return 32, network, 32
+            if network >> 32 == 0xffff:
+                return 32, network & 0xffff_ffff, 32
+            return 128, network, 128
+
         net = ip_network(network)
+        addr = int(net.network_address)
         if isinstance(net, IPv4Network):
-            # embed the IPv4 into an IPv6
-            net = ip_network(f"::ffff:{net.network_address}/{net.prefixlen + 96}")
-        
-        here = self.tree
-        prefix = f"{int(net.network_address):0128b}"[:net.prefixlen]
-        for b in prefix:
-            b = int(b)
-            if here[b] is None:                
-                here[b] = [None, None, None]            
-            here = here[b]            
-        here[2] = data
+            return 32, addr, net.prefixlen
+        if addr >> 32 == 0xffff and net.prefixlen >= 96:
+            return 32, addr & 0xffff_ffff, net.prefixlen - 96
+        return 128, addr, net.prefixlen
 
 
+    def insert(self, network: str, data: Any):
+        """Insert the data at the appropriate part of the tree.  Once the tree
+        is compiled this goes into the overlay rather than rebuilding it."""
+        width, addr, plen = self._parse(network)
+        if self.tree is None:
+            if self._overlay is None:
+                self._overlay = NetTree()
+            self._overlay._insert(width, addr, plen, data)
+        else:
+            self._insert(width, addr, plen, data)
+
+
+    def _insert(self, width: int, addr: int, plen: int, data: Any):
+        """Insert the data for the address and prefix length into the trie for
+        the address width"""
+        # networks usually arrive in address order (networks.csv is sorted), 
+        # so rather than walking down from the root each time, start from the
+        # deepest node on the previous insert's path that contains this one.
+        path = self._paths[0 if width == 32 else 1]
+        i = len(path) - 1
+        while i > 0:
+            node = path[i]
+            if node.depth <= plen and addr >> (width - node.depth) == node.bits:
+                break
+            i -= 1
+        del path[i + 1:]
+        here = path[i]
+        while True:
+            depth = here.depth
+            if depth == plen:
+                here.data = data
+                return
+            b = (addr >> (width - 1 - depth)) & 1
+            child = here.c1 if b else here.c0
+            if child is None:
+                child = _Node(plen, addr >> (width - plen), data)
+                path.append(child)
+            elif child.depth <= plen and addr >> (width - child.depth) == child.bits:
+                here = child
+                path.append(child)
+                continue
+            else:
+                # the prefix diverges from the child somewhere along the edge, 
+                # so a new node has to be spliced in where they part ways.
+                n = min(plen, child.depth)
+                common = n - ((addr >> (width - n)) ^ (child.bits >> (child.depth - n))).bit_length()
+                node = _Node(common, addr >> (width - common))
+                path.append(node)
+                if (child.bits >> (child.depth - common - 1)) & 1:
+                    node.c1 = child
+                else:
+                    node.c0 = child
+                if common == plen:
+                    node.data = data
+                else:
+                    leaf = _Node(plen, addr >> (width - plen), data)
+                    path.append(leaf)
+                    if (addr >> (width - 1 - common)) & 1:
+                        node.c1 = leaf
+                    else:
+                        node.c0 = leaf
+                child = node
+            if b:
+                here.c1 = child
+            else:
+                here.c0 = child
+            return
+
+
+    def _match(self, width: int, addr: int, plen: int):
+        """Return the most specific _Node with data containing the address and
+        prefix length in the uncompiled tree, or None"""
+        node = self.tree[0 if width == 32 else 1]
+        found = None
+        while node is not None and node.depth <= plen and addr >> (width - node.depth) == node.bits:
+            if node.data:
+                found = node
+            if node.depth == plen:
+                break
+            node = node.c1 if (addr >> (width - 1 - node.depth)) & 1 else node.c0
+        return found
+
 
     def search(self, network):
         """Walk the tree based on the network prefix and return the most specific
            data found."""
-        net = ip_network(network)
-        if isinstance(net, IPv4Network):
-            # embed the IPv4 into an IPv6
-            net = ip_network(f"::ffff:{net.network_address}/{net.prefixlen + 96}")
-        here = self.tree
-        prefix = f"{int(net.network_address):0128b}"[:net.prefixlen]        
-        net = None
-        for b in prefix:
-            if here[2]:
-                net = here[2]
-            b = int(b)
-            if here[b] is None:                                
-                break            
-            here = here[b]
-        return net
+        return self.search_many((network,))[0]
+
+
+    def search_many(self, networks) -> list:
+        """Search for each of the networks, returning a list of the results.  
+        This saves the per-call overhead of search() for bulk lookups."""
+        if self.tree is not None:
+            self.compile()
+        overlay = self._overlay
+        parse = self._parse
+        parse_str = _parse_str
+        depth = self._depth
+        children = self._children
+        entries = self._entries
+        data_depth = self._data_depth
+        data_bits = self._data_bits
+        data_parent = self._data_parent
+        data_objs = self._data_objs
+        stride = self.STRIDE
+        slots = self.STRIDE_SLOTS
+        mask = slots - 1
+        results = []
+        for network in networks:
+            if type(network) is str:
+                width, addr, plen = parse_str(network)
+            else:
+                width, addr, plen = parse(network)
+            # padding the address out by a stride lets the nodes near the end
+            # of the address use full width slots too.
+            padded = addr << stride
+            node = 0 if width == 32 else 1
+            found = -1
+            while node >= 0:
+                i = node * slots + ((padded >> (width - depth[node])) & mask)
+                if entries[i] >= 0:
+                    found = entries[i]
+                node = children[i]
+
+            # the walk skipped over the bits of the compressed edges, so make
+            # sure what it found really contains the address
+            while found >= 0:
+                d = data_depth[found]
+                if d <= plen and addr >> (width - d) == data_bits[found]:
+                    break
+                found = data_parent[found]
+            if overlay is not None:
+                # later inserts replace the same network, so the overlay wins ties
+                extra = overlay._match(width, addr, plen)
+                if extra is not None and (found < 0 or extra.depth >= data_depth[found]):
+                    results.append(extra.data)
+                    continue
+            results.append(data_objs[found] if found >= 0 else None)
+        return results
+
+
+# lookups often see the same addresses over and over (think of log files), 
+# so remember the most recently parsed ones.  Inserts don't go through here
+# since every network loaded is different.
+@lru_cache(maxsize=100_000)
+def _parse_str(network: str) -> tuple[int, int, int]:
+    """NetTree._parse() for address strings, with a cache"""
+    return NetTree._parse(network)
 
 
 class IPGuide:
     """This is the main IPGuide Database"""
     def __init__(self, filename, download: bool=True, use_pickle: bool=True, max_age_days: float=7):
-        """Initialize the ip.guide database.  Optionally download the data if needed, pickle it for
-        faster future starts, and refresh it if it's too old"""
+        """Initialize the ip.guide database.  Optionally download the data if needed, cache it for
+        faster future starts (use_pickle), and refresh it if it's too old"""
         self.filename = Path(filename)
-        self.pickle = Path(filename).with_suffix(".pickle") if use_pickle else None
+        self.cache = Path(filename).with_suffix(".cache") if use_pickle else None
         self.database = None  
+        self._mmap = None
 
         if not self.filename.exists():
             # the database doesn't exist, so we probably need to download it.
@@ -113,85 +526,217 @@ class IPGuide:
         
     def download_database(self):
         """Download the database file if possible"""
+        tmpfile = self.filename.with_suffix(".new")        
         try:
-            tmpfile = self.filename.with_suffix(".new")        
             logging.debug(f"Refreshing bulk IP Guide data into temp file: {tmpfile}")                
-            subprocess.run(['curl', '-o', str(tmpfile), 'https://ip.guide/bulk/networks.csv'],
-                            check=True)
-            tmpfile.rename(self.filename)
+            request = urllib.request.Request('https://ip.guide/bulk/networks.csv',
+                                             headers={'Accept-Encoding': 'gzip'})
+            with urllib.request.urlopen(request, timeout=60) as response, open(tmpfile, "wb") as f:
+                source = response
+                if response.headers.get('Content-Encoding') == 'gzip':
+                    source = gzip.GzipFile(fileobj=response)
+                shutil.copyfileobj(source, f, 1024 * 1024)
+            tmpfile.replace(self.filename)
         except Exception as e:
-            logging.exception("Can't refresh ip.guide data: {e}")
+            logging.exception(f"Can't refresh ip.guide data: {e}")
+            tmpfile.unlink(missing_ok=True)
 
 
     def load_database(self):
-        """Load the database data.  Use the pickled version if it's available"""
+        """Load the database data.  Use the cached version if it's available"""
         if not self.filename.exists():
             raise FileNotFoundError(f"Cannot find the IPGuide source csv: {self.filename}")
 
-        if self.pickle is None or not self.pickle.exists() or self.pickle.stat().st_mtime < self.filename.stat().st_mtime:
+        self.database = None
+        # let go of the previous cache's mapping, so it can be replaced
+        self._mmap = None
+        # forget the indexes built from any previous database
+        self.__dict__.pop('_indexes', None)
+        if self.cache is not None and self.cache.exists() and self.cache.stat().st_mtime >= self.filename.stat().st_mtime:
+            logging.debug("Loading cached ip.guide data")
+            self.database = self.read_cache()
+
+        if self.database is None:
             logging.debug(f"Loading the ip.guide data from {self.filename}")
-            self.database = {'network': NetTree(),
-                             'asn': {},
-                             'country': {}}
+            tree = NetTree()
+            # the rows, as (network, asn, country), for building the asn and 
+            # country indexes when they're needed.
+            rows = []
+            # the first row seen for each ASN supplies its name and country
+            asn_rows = {0: [None, 0, 'Locally routed network', '*']}
+            asn_ids = {}
+
+            for pnet in PRIVATE_NETWORKS:
+                tree.insert(pnet, (pnet, 0, '*'))
 
             with open(self.filename, newline='') as cfile:
                 reader = csv.reader(cfile)
+                # skip the header here so the loop doesn't have to look for it
+                next(reader, None)
                 for row in reader:
-                    if row[0] == 'network':
-                        # this is the header, but we'll use this opportunity
-                        # to include records for the private networks.                        
-                        private = ['10.0.0.0/8', '127.0.0.0/8',
-                                    '172.16.0.0/12', '192.168.0.0/16',
-                                    '::1/128', 'fc00::/7', 'fe80::/10']
-                        for pnet in private:
-                            self.database['network'].insert(pnet, (pnet, 0, '*'))
-                        self.database['asn'][0] = {
-                            'name': 'Locally routed network',
-                            'country': '*',
-                            'networks': private
-                        }
-                        self.database['country']['*'] = [0]
-                        continue
-
-                    asn = int(row[1])
-                    self.database['network'].insert(row[0], (row[0], asn, row[3]))
-                    if asn not in self.database['asn']:
-                        self.database['asn'][asn] = {
-                            'name': row[2],
-                            'country': row[3],
-                            'networks': []
-                        }
-                    self.database['asn'][asn]['networks'].append(row[0])
-                    if row[3] not in self.database['country']:
-                        self.database['country'][row[3]] = []
-                    self.database['country'][row[3]].append(asn)
-
-            if self.pickle is not None:
-                with open(self.pickle, "wb") as f:
-                    pickle.dump(self.database, f)
+                    # share one int per ASN and one string per country code
+                    # rather than holding a fresh copy for every network.
+                    asn = asn_ids.get(row[1])
+                    if asn is None:
+                        asn = asn_ids[row[1]] = int(row[1])
+                    country = row[3] = sys.intern(row[3])
+                    data = (row[0], asn, country)
+                    tree.insert(row[0], data)
+                    rows.append(data)
+                    asn_rows.setdefault(asn, row)
+
+            self.database = {'network': tree,
+                             'rows': rows,
+                             'asn_info': {asn: (row[2], row[3]) for asn, row in asn_rows.items()}}
+            self.database['network'].compile()
+            if self.cache is not None:
+                # the database is still usable without a cache, and the file
+                # can't be replaced on Windows while another process maps it
+                try:
+                    self.write_cache()
+                except OSError as e:
+                    logging.warning(f"Cannot write the ip.guide cache {self.cache}: {e}")
+
+
+    def write_cache(self):
+        """Write the database to the cache file.
+
+        The file is a header holding the offset and length of each section, 
+        the trie's arrays as raw, 8-byte aligned machine data, and then a 
+        marshalled blob with everything else.  Unlike a pickle, loading it 
+        can't run any code.  The new file is renamed into place so a process 
+        which has the old one mapped keeps a consistent view of it."""
+        tree = self.database['network'].to_dict()
+        sections = [tree.pop(name).tobytes() for name, _ in NetTree.ARRAYS]
+        sections.append(marshal.dumps({'network': tree,
+                                       'rows': self.database['rows'],
+                                       'asn_info': self.database['asn_info']}))
+        offset = CACHE_HEADER.size + CACHE_SECTION.size * len(sections)
+        index = b""
+        for section in sections:
+            offset += -offset % 8
+            index += CACHE_SECTION.pack(offset, len(section))
+            offset += len(section)
+
+        tmpfile = self.cache.with_name(self.cache.name + ".new")
+        try:
+            with open(tmpfile, "wb") as f:
+                f.write(CACHE_HEADER.pack(CACHE_MAGIC, CACHE_VERSION, CACHE_BYTEORDER,
+                                          CACHE_INTSIZE, len(sections)))
+                f.write(index)
+                for section in sections:
+                    f.write(b"\0" * (-f.tell() % 8))
+                    f.write(section)
+            tmpfile.replace(self.cache)
+        except OSError:
+            tmpfile.unlink(missing_ok=True)
+            raise
+
+
+    def read_cache(self):
+        """Read the database from the cache file.  The trie's arrays are 
+        zero-copy views into the memory mapped file, so they're paged in as
+        they're used and shared between processes using the same cache.
+        Returns None if the cache can't be used"""
+        mm = None
+        database = None
+        try:
+            with open(self.cache, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            database = self._map_cache(mm)
+        except (OSError, EOFError, ValueError, TypeError, struct.error) as e:
+            logging.debug(f"Cannot read the cached ip.guide data: {e}")
+
+        if database is None:
+            # nothing refers to the mapping by now, so it can be closed
+            if mm is not None:
+                mm.close()
+            return None
+        # the views keep the mapping alive, but hold on to it explicitly too
+        self._mmap = mm
+        return database
+
+
+    @staticmethod
+    def _map_cache(mm: mmap.mmap):
+        """Build the database from a memory mapped cache file.  Returns None
+        if it was written by a different version or on a different kind of 
+        machine"""
+        magic, version, byteorder, intsize, count = CACHE_HEADER.unpack_from(mm)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION or count != len(NetTree.ARRAYS) + 1:
+            logging.debug("Cached ip.guide data was written by a different version, rebuilding it")
+            return None
+        if byteorder != CACHE_BYTEORDER or intsize != CACHE_INTSIZE:
+            logging.debug("Cached ip.guide data was written on a different platform, rebuilding it")
+            return None
+        view = memoryview(mm)
+        sections = []
+        for i in range(count):
+            offset, length = CACHE_SECTION.unpack_from(mm, CACHE_HEADER.size + CACHE_SECTION.size * i)
+            if offset + length > len(mm):
+                raise ValueError("cache file is truncated")
+            sections.append(view[offset:offset + length])
+
+        # the garbage collector would otherwise repeatedly scan the millions
+        # of containers as they're created, and none of them can be garbage.
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            database = marshal.loads(sections.pop())
+        finally:
+            if gc_enabled:
+                gc.enable()
 
-        else:
-            logging.debug("Loading pickled ip.guide data")
-            with open(self.pickle, "rb") as f:
-                self.database = pickle.load(f)
+        tree = database['network']
+        for (name, typecode), section in zip(NetTree.ARRAYS, sections):
+            tree[name] = section.cast(typecode)
+        database['network'] = NetTree.from_dict(tree)
+        return database
 
 
     def find_network(self, network):
+        """Find the most specific network record containing network, which can
+        be an address or CIDR string, an IPv4Address/IPv6Address or an int"""
         return self.database['network'].search(network)
     
 
+    def find_networks(self, networks) -> list:
+        """Find the network records for each of an iterable of networks, in
+        order.  This avoids the per-call overhead of find_network() in a loop."""
+        return self.database['network'].search_many(networks)
+
+
+    @cached_property
+    def _indexes(self) -> dict:
+        """The per-ASN and per-country indexes.  Plenty of callers only ever
+        look up networks, so these are built from the rows on first use
+        rather than when the database is loaded."""
+        asn_networks = defaultdict(list)
+        countries = defaultdict(list)
+        asn_networks[0] = list(PRIVATE_NETWORKS)
+        countries['*'].append(0)
+        for network, asn, country in self.database['rows']:
+            asn_networks[asn].append(network)
+            countries[country].append(asn)
+        return {'asn': {asn: {'name': name,
+                              'country': country,
+                              'networks': asn_networks[asn]}
+                        for asn, (name, country) in self.database['asn_info'].items()},
+                'country': dict(countries)}
+
+
     def networks_for_asn(self, asn):
-        if asn not in self.database['asn']:
+        if asn not in self._indexes['asn']:
             return []
         else:
-            return self.database['asn'][asn].get('networks', [])
+            return self._indexes['asn'][asn].get('networks', [])
 
     def find_asn(self, asn):
-        return self.database['asn'].get(asn, None)
+        return self._indexes['asn'].get(asn, None)
     
 
     def find_country(self, country):
-        return self.database['country'].get(country, [])
+        return self._indexes['country'].get(country, [])
 
 
     def get_networks(self, spec):